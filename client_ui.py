@@ -2,40 +2,118 @@
 Functions to display a clean client UI.
 """
 
+from typing import List, Optional
+from collections import deque
+from itertools import islice
+import signal
+import socket
 import sys
-from os import get_terminal_size
+from shutil import get_terminal_size
 
-from lcsocket import LCSocket
+from lcsocket import LCSocket, ConnectionClosed, BadPacket
 
 
-chat_history = ["\033[2K"]
+# Escape sequences used for drawing, bound once at import.
+# They are pre-encoded since drawing writes bytes straight to the stdout buffer.
+SAVE_CURSOR = b"\033[s"
+RESTORE_CURSOR = b"\033[u"
+RESET_SCROLL_REGION = b"\033[r"
+CLEAR_LINE = b"\033[2K\033[1G"
+# Move cursor up one line and clear it. \033[F already returns to the first column.
+LINE_PREFIX = b"\033[F\033[2K"
+
+# Newest chat first, encoded ready to draw. Bounded so long sessions don't grow without limit.
+chat_history = deque([b"\033[2K"], maxlen=200)
+
+# Cached so drawing doesn't ask the terminal for its size every time. Updated on resize.
+_TERM_COLS, _TERM_ROWS = get_terminal_size()
+
+# Set by the SIGWINCH handler. The redraw itself happens in handle_resize.
+_resized = False
+# Kept open for signal.set_wakeup_fd. See start_chat_screen.
+_signal_sock = None
+
+
+def _on_resize(_signum, _frame):
+    """
+    SIGWINCH handler. Only note the resize, since drawing here could interleave with a draw
+    the signal interrupted.
+    """
+    global _resized
+    _resized = True
+
 
 def print_chat():
     """
     Print out the messages in a nice manner.
+    This is a full redraw, only needed at startup and when the terminal is resized.
     """
-    # Save cursor position
-    print_nol("\033[s", flush=False)
+    # Save cursor position, and limit scrolling to the rows above the input line.
+    # Setting the scroll region moves the cursor, so restore it straight away.
+    parts = [SAVE_CURSOR, f"\033[1;{_TERM_ROWS - 1}r".encode(), RESTORE_CURSOR]
 
-    for chat in chat_history:
-        # Move cursor up one line and clear it
-        print_nol("\033[F\033[2K\033[1G", flush=False)
-        print_nol(chat, flush=False)
+    visible_chats = list(islice(chat_history, _TERM_ROWS - 1))
+    for chat in visible_chats:
+        parts.append(LINE_PREFIX)
+        parts.append(chat)
 
-    print_nol((len(chat_history)) * "\033[E")
+    # Move back down past every line drawn
+    parts.append(f"\033[{len(visible_chats)}E".encode())
 
     # Return to saved position
-    print_nol("\033[u")
+    parts.append(RESTORE_CURSOR)
+
+    # Write the whole redraw at once rather than one print per line
+    write_raw(b"".join(parts))
 
 
 
 def add_chat(msg: str):
     """
     Add a chat to the chat history and display chats.
+    Only the new lines are drawn; the scroll region set by print_chat moves the old ones up.
     """
+    # Save cursor position and go to the bottom of the scroll region
+    parts = [SAVE_CURSOR, f"\033[{_TERM_ROWS - 1};1H".encode()]
+
     for line in msg.split("\n"):
-        chat_history.insert(0, line)
-    print_chat()
+        for row in process_word_wrap(line):
+            row = row.encode()
+            chat_history.appendleft(row)
+            # A newline at the bottom of the scroll region scrolls it up by one, leaving a blank line
+            parts.append(b"\n")
+            parts.append(row)
+
+    parts.append(RESTORE_CURSOR)
+
+    write_raw(b"".join(parts))
+
+
+def process_word_wrap(line: str) -> List[str]:
+    """
+    Split a line into rows that fit the width of the terminal.
+    """
+    width = _TERM_COLS
+    if len(line) <= width:
+        return [line]
+    return [line[i:i + width] for i in range(0, len(line), width)]
+
+
+def reset_scroll_region():
+    """
+    Let the whole terminal scroll again.
+    """
+    write_raw(SAVE_CURSOR + RESET_SCROLL_REGION + RESTORE_CURSOR)
+
+
+def write_raw(data: bytes):
+    """
+    Write already encoded bytes to stdout, skipping the text layer's encoding.
+    """
+    # Anything printed as text must go out first to keep the output in order
+    sys.stdout.flush()
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
 
 
 def print_nol(string: str, flush=True):
@@ -49,32 +127,71 @@ def clear_current_line():
     """
     Clear the current line.
     """
-    sys.stdout.write("\033[2K\033[1G")
+    write_raw(CLEAR_LINE)
 
 
 def clear_last_line():
     """
     Clear the last line.
     """
-    sys.stdout.write("\033[F\033[2K\033[1G")
+    write_raw(LINE_PREFIX)
 
 
-def msg_handler(client: LCSocket):
+def start_chat_screen() -> Optional[socket.socket]:
     """
-    A thread function to receive messages and display them.
+    Make room for the chat above the input line and draw it.
+    Returns a socket that becomes readable when the terminal is resized, for the caller to
+    select on and pass to handle_resize. None if the platform has no resize signal.
     """
-    for _ in range(get_terminal_size()[1]):
+    for _ in range(_TERM_ROWS):
         print()
+    print_chat()
 
-    while True:
-        # When trying to receive from client, will raise AttributeError if host disconnected.
-        try:
-            data = client.full_receive()
-        except AttributeError:
-            client.close()
-            add_chat("Host unexpectedly disconnected. Press enter to exit.")
-            return
+    if not hasattr(signal, "SIGWINCH"):
+        return None
+
+    global _signal_sock
+    # The signal writes a byte to the other end, waking up a selector waiting on this one
+    wakeup_sock, _signal_sock = socket.socketpair()
+    wakeup_sock.setblocking(False)
+    _signal_sock.setblocking(False)
+    signal.set_wakeup_fd(_signal_sock.fileno())
+    signal.signal(signal.SIGWINCH, _on_resize)
+    return wakeup_sock
 
+
+def handle_resize(wakeup_sock: socket.socket):
+    """
+    Redraw the chat for the new terminal size, if it was resized.
+    Call when the socket from start_chat_screen is readable.
+    """
+    global _TERM_COLS, _TERM_ROWS, _resized
+    try:
+        while wakeup_sock.recv(64):
+            pass
+    except BlockingIOError:
+        pass
+
+    if _resized:
+        _resized = False
+        _TERM_COLS, _TERM_ROWS = get_terminal_size()
+        print_chat()
+
+
+def msg_handler(client: LCSocket) -> bool:
+    """
+    Receive the messages that have arrived and display them.
+    Call when the client is readable; it reads the socket once, so it never blocks
+    waiting for the rest of a packet. Returns False once disconnected.
+    """
+    try:
+        packets = client.receive_available()
+    except (ConnectionClosed, BadPacket, OSError):
+        client.close()
+        add_chat("Host unexpectedly disconnected. Press enter to exit.")
+        return False
+
+    for data in packets:
         msg = data["message"]
         sender = data["source"]
 
@@ -84,4 +201,6 @@ def msg_handler(client: LCSocket):
 
         if data["action"] == "DISCONNECT":
             client.close()
-            return
+            return False
+
+    return True
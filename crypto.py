@@ -2,26 +2,73 @@
 Functions for encryption and decryption.
 """
 
-from typing import Tuple
-import random
+from typing import Tuple, List, Iterable
+import hashlib
+import os
+import secrets
+import warnings
 
-import pyDes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.utils import CryptographyDeprecationWarning
+
+try:
+    from gmpy2 import powmod, mpz
+except ImportError:
+    powmod = pow
+    mpz = int
+
+# Finite field Diffie Hellman is deprecated in cryptography, so it may go away in a later version.
+try:
+    from cryptography.hazmat.primitives.asymmetric import dh
+except ImportError:
+    dh = None
 
 from prime import get_prime_of_size
 
-def encrypt(key: int, value: str) -> bytes:
-    """ Encrypt value using DES and the symmetric key. """
-    encrypter = pyDes.des(key.to_bytes(8, "big"), pad=None, padmode=pyDes.PAD_PKCS5)
-    return encrypter.encrypt(value.encode())
+NONCE_SIZE = 12
+
+# The smallest modulus OpenSSL will generate Diffie Hellman parameters for.
+DH_KEY_SIZE = 512
+
+def _derive_key(key: int) -> bytes:
+    """ Derive a 128 bit AES key from the Diffie Hellman shared secret. """
+    key_bytes = key.to_bytes((key.bit_length() + 7) // 8, "big")
+    return hashlib.sha256(key_bytes).digest()[:16]
+
+def make_cipher(key: int) -> AESGCM:
+    """ Make the cipher for the symmetric key. Build it once and reuse it for every packet. """
+    return AESGCM(_derive_key(key))
+
+def encrypt(cipher: AESGCM, value: bytes) -> bytes:
+    """ Encrypt value using AES-GCM and the cipher. Returns nonce + ciphertext. """
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + cipher.encrypt(nonce, value, None)
+
+def decrypt(cipher: AESGCM, encrypted_value_bytes: bytes) -> bytes:
+    """ Decrypt value using AES-GCM and the cipher. """
+    nonce = encrypted_value_bytes[:NONCE_SIZE]
+    ciphertext = encrypted_value_bytes[NONCE_SIZE:]
+    return cipher.decrypt(nonce, ciphertext, None)
+
+def numbers_to_bytes(numbers: Iterable[int], width: int) -> bytes:
+    """ Pack numbers as big-endian integers of `width` bytes each, for sending. """
+    return b"".join(number.to_bytes(width, "big") for number in numbers)
 
-def decrypt(key: int, encrypted_value_bytes: bytes) -> str:
-    """ Decrypt value using DES and the symmetric key. """
-    decrypter = pyDes.des(key.to_bytes(8, "big"), pad=None, padmode=pyDes.PAD_PKCS5)
-    return decrypter.decrypt(encrypted_value_bytes).decode()
+def bytes_to_numbers(data: bytes, count: int) -> List[int]:
+    """ Unpack `count` big-endian integers of equal width, packed by numbers_to_bytes. """
+    width = len(data) // count
+    return [int.from_bytes(data[i:i + width], "big") for i in range(0, count * width, width)]
 
 def get_n_and_g() -> Tuple[int, int]:
-    """ Get a suitable n and g value such that we can use DES. Returns (n, g). """
-    return get_prime_of_size(64), get_prime_of_size(32)
+    """ Get a suitable n and g value such that we can derive an AES key. Returns (n, g). """
+    if dh is not None:
+        # OpenSSL generates a safe prime for n in C, and 2 generates a large subgroup of it.
+        with warnings.catch_warnings():
+            # Only silence cryptography's warning that finite field Diffie Hellman is deprecated
+            warnings.filterwarnings("ignore", category=CryptographyDeprecationWarning)
+            numbers = dh.generate_parameters(generator=2, key_size=DH_KEY_SIZE).parameter_numbers()
+        return numbers.p, numbers.g
+    return get_prime_of_size(256), get_prime_of_size(32)
 
 def diffie_first_step(secret_key: int, large_prime_n: int, prime_g: int) -> int:
     """
@@ -31,7 +78,7 @@ def diffie_first_step(secret_key: int, large_prime_n: int, prime_g: int) -> int:
         n: Large prime number, must be same as other client. It can be known.
         g: Generator. Should be prime root of n.
     """
-    return pow(prime_g, secret_key, large_prime_n)
+    return int(powmod(prime_g, secret_key, large_prime_n))
 
 def diffie_second_step(public_key: int, secret_key: int, large_prime_n: int) -> int:
     """
@@ -41,10 +88,15 @@ def diffie_second_step(public_key: int, secret_key: int, large_prime_n: int) ->
         secret_key: Your unshared secret key.
         n: Large prime number, must be same as other client. It can be known.
     """
-    return pow(public_key, secret_key, large_prime_n)
+    return int(powmod(public_key, secret_key, large_prime_n))
 
 def get_private_key(large_prime_n: int) -> int:
     """
-    Get a private key.
+    Get a private key between 2 and n - 2.
     """
-    return random.randint(1,large_prime_n)
+    # n has its top bit set, so fewer than 2 draws are needed on average.
+    bits = large_prime_n.bit_length()
+    while True:
+        private_key = secrets.randbits(bits)
+        if 1 < private_key < large_prime_n - 1:
+            return private_key
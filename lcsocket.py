@@ -2,11 +2,126 @@
 This module contains a class for lan-chat socket.
 """
 
-from typing import Dict
+from typing import Dict, List, Optional
 import socket
-import json
+import struct
 
-from crypto import encrypt, decrypt
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+    def json_dumps(data: Dict[str, str]) -> bytes:
+        """ Fallback for orjson.dumps, which returns bytes. """
+        return json.dumps(data).encode()
+
+from cryptography.exceptions import InvalidTag
+
+from crypto import make_cipher, encrypt, decrypt
+
+# Every packet on the wire is prefixed with its length as a 4 byte big-endian integer.
+HEADER = struct.Struct(">I")
+# Lets the header and payload go out in one call without joining them. Not on Windows.
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+BUFFER_SIZE = 65536
+# The longest packet accepted, so a peer can't make the receive buffer grow without limit.
+# Well over the largest compact packet, whose fields are at most MAX_FIELD_SIZE each.
+MAX_PACKET_SIZE = 256 * 1024
+
+# The frequent actions skip JSON and are packed as a tag, the field lengths, then the fields.
+MESSAGE_TAG = 1
+CONNECT_TAG = 2
+DISCONNECT_TAG = 3
+# SETUP_ENCRYPTION messages are binary and are sent as they are, not as UTF-8 text
+SETUP_TAG = 4
+ERROR_TAG = 5
+COMPACT_HEADER = struct.Struct(">BHH")
+MAX_FIELD_SIZE = 0xFFFF
+# The longest chat message, UTF-8 encoded. Longer ones aren't sent or relayed,
+# so every chat message fits the compact format and stays under MAX_PACKET_SIZE.
+MAX_MESSAGE_SIZE = MAX_FIELD_SIZE
+
+ACTION_TAGS = {
+    "MESSAGE": MESSAGE_TAG,
+    "CONNECT": CONNECT_TAG,
+    "DISCONNECT": DISCONNECT_TAG,
+    "SETUP_ENCRYPTION": SETUP_TAG,
+    "ERROR": ERROR_TAG
+}
+TAG_ACTIONS = {tag: action for action, tag in ACTION_TAGS.items()}
+
+
+def pack_compact(tag: int, source_bytes: bytes, message_bytes: bytes) -> Optional[bytes]:
+    """
+    Pack a packet in the compact format. Returns None if a field is too long for it.
+    source_bytes: The UTF-8 encoded source, so a constant source only needs encoding once.
+    """
+    if len(source_bytes) > MAX_FIELD_SIZE or len(message_bytes) > MAX_FIELD_SIZE:
+        return None
+    return COMPACT_HEADER.pack(tag, len(source_bytes), len(message_bytes)) \
+        + source_bytes + message_bytes
+
+
+def unpack_compact(payload: bytes) -> Dict[str, str]:
+    """
+    Unpack a packet in the compact format.
+    """
+    tag, source_size, message_size = COMPACT_HEADER.unpack_from(payload)
+    source_end = COMPACT_HEADER.size + source_size
+    message = payload[source_end:source_end + message_size]
+    if tag != SETUP_TAG:
+        message = message.decode()
+    return {
+        "action": TAG_ACTIONS[tag],
+        "message": message,
+        "source": payload[COMPACT_HEADER.size:source_end].decode()
+    }
+
+
+def pack_packet(data: Dict[str, str]) -> bytes:
+    """
+    Pack a packet into the payload that full_send sends.
+    Packing it once lets the same payload be sent to many sockets with send_payload.
+    """
+    tag = ACTION_TAGS.get(data["action"])
+    if tag is not None:
+        message = data["message"]
+        if tag != SETUP_TAG:
+            message = message.encode()
+        payload = pack_compact(tag, data["source"].encode(), message)
+        if payload is not None:
+            return payload
+    return json_dumps(data)
+
+
+def pack_message(source_bytes: bytes, message: str) -> bytes:
+    """
+    Pack a MESSAGE packet without building a packet dict first.
+    source_bytes: The UTF-8 encoded source. Encode it once and reuse it for every message.
+    """
+    payload = pack_compact(MESSAGE_TAG, source_bytes, message.encode())
+    if payload is None:
+        payload = json_dumps({
+            "action": "MESSAGE",
+            "message": message,
+            "source": source_bytes.decode()
+        })
+    return payload
+
+
+class ConnectionClosed(Exception):
+    """
+    Raised when the other end of the connection has closed it.
+    """
+
+
+class BadPacket(Exception):
+    """
+    Raised when a received packet can't be decrypted or decoded.
+    """
 
 
 class LCSocket:
@@ -14,50 +129,156 @@ class LCSocket:
     lan-chat socket - a class to wrap around socket.socket.
     """
     def __init__(self, sock: socket.socket) -> None:
-        self._msg_q = []
-        self._partial_packet = ""
         self._sock: socket.socket = sock
 
+        # Received bytes live in _buf[_start:_end] until a full packet can be taken out.
+        self._buf = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
         # Socket should already be connected at construction of LCSocket
         self._connected = True
 
-        self._encryption_key = None
+        self._cipher = None
 
 
     def set_encryption_key(self, key):
         """ Set the encryption key and enable encryption from here on. """
-        self._encryption_key = key
+        self._cipher = make_cipher(key)
 
 
     def full_send(self, data: Dict[str, str]) -> None:
         """
         Send a full packet.
         """
-        if self._encryption_key is None:
-            self._sock.sendall(json.dumps(data).encode())
+        self.send_payload(pack_packet(data))
+
+
+    def send_message(self, source_bytes: bytes, message: str) -> None:
+        """
+        Send a MESSAGE packet without building a packet dict first. See pack_message.
+        """
+        self.send_payload(pack_message(source_bytes, message))
+
+
+    def send_payload(self, payload: bytes) -> None:
+        """
+        Encrypt if enabled, then send the payload with its length prefix.
+        payload: A packet packed by pack_packet.
+        """
+        if self._cipher is not None:
+            payload = encrypt(self._cipher, payload)
+
+        header = HEADER.pack(len(payload))
+        if not HAS_SENDMSG:
+            self._sock.sendall(header + payload)
             return
 
-        self._sock.sendall(encrypt(self._encryption_key, json.dumps(data)))
+        sent = self._sock.sendmsg((header, payload))
+        if sent < len(header) + len(payload):
+            # The socket buffer was full. Rare enough to send the rest the simple way.
+            self._sock.sendall((header + payload)[sent:])
 
 
     def full_receive(self) -> Dict[str, str]:
         """
         Receive 1 full packet.
         Blocks until packet is available.
+        Raises ConnectionClosed if the other end disconnected,
+        and BadPacket if the packet is corrupt or forged.
+        """
+        payload = self._next_payload()
+        while payload is None:
+            self._fill()
+            payload = self._next_payload()
+
+        try:
+            if self._cipher is not None:
+                payload = decrypt(self._cipher, payload)
+
+            # JSON packets start with "{", never with one of the compact tags
+            if payload[0] in TAG_ACTIONS:
+                return unpack_compact(payload)
+
+            packet = json_loads(payload)
+        except (InvalidTag, IndexError, ValueError, struct.error) as error:
+            raise BadPacket from error
+        if not isinstance(packet, dict):
+            raise BadPacket
+        return packet
+
+
+    def receive_available(self) -> List[Dict[str, str]]:
+        """
+        Receive the bytes waiting on the socket and return every full packet received so far.
+        Reads from the socket only once, so it doesn't block once the socket is readable.
+        Raises ConnectionClosed if the other end disconnected, and BadPacket like full_receive.
+        """
+        self._fill()
+        packets = []
+        while self.has_packet():
+            packets.append(self.full_receive())
+        return packets
+
+
+    def has_packet(self) -> bool:
+        """
+        Check if a full packet has already been received and is waiting to be read.
+        Raises BadPacket if the next packet is longer than MAX_PACKET_SIZE.
+        """
+        available = self._end - self._start
+        if available < HEADER.size:
+            return False
+
+        (length,) = HEADER.unpack_from(self._buf, self._start)
+        if length > MAX_PACKET_SIZE:
+            raise BadPacket
+        return available >= HEADER.size + length
+
+
+    def _next_payload(self) -> Optional[bytes]:
+        """
+        Take the next full packet out of the receive buffer, or None if it hasn't fully arrived.
+        """
+        if not self.has_packet():
+            return None
+
+        (length,) = HEADER.unpack_from(self._buf, self._start)
+        payload_start = self._start + HEADER.size
+        payload = bytes(self._view[payload_start:payload_start + length])
+        self._start = payload_start + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return payload
+
+
+    def _fill(self) -> None:
+        """
+        Receive more bytes from the socket into the receive buffer.
         """
-        if self._encryption_key is None:
-            msg = self._sock.recv(4096).decode()
-            return json.loads(msg)
+        if self._end == len(self._buf):
+            pending = bytes(self._view[self._start:self._end])
+            if self._start == 0:
+                # A single packet is larger than the buffer, so grow it.
+                self._view.release()
+                self._buf = bytearray(2 * len(self._buf))
+                self._view = memoryview(self._buf)
+            self._buf[:len(pending)] = pending
+            self._start = 0
+            self._end = len(pending)
 
-        msg = decrypt(self._encryption_key, self._sock.recv(4096))
-        return json.loads(msg)
+        received = self._sock.recv_into(self._view[self._end:])
+        if received == 0:
+            raise ConnectionClosed
+        self._end += received
 
 
-    def settimeout(self, timeout: float) -> None:
+    def fileno(self) -> int:
         """
-        Set the timeout of the socket.
+        Get the file descriptor of the socket, so it can be used with selectors.
         """
-        self._sock.settimeout(timeout)
+        return self._sock.fileno()
 
 
     def close(self) -> None:
@@ -1,9 +1,12 @@
 """
 This is the entrypoint for this Python application.
-It is all the client-side code and is what spawns off the server and UI threads.
+It is all the client-side code and is what spawns off the server thread and runs the UI.
 """
 
 from typing import Tuple, List
+import os
+import queue
+import selectors
 import socket
 import threading
 import time
@@ -11,19 +14,80 @@ import sys
 
 import netifaces
 
-from server import Server, DEFAULT_PORT, BROADCAST_RESPONSE, BROADCAST_PACKET
-from lcsocket import LCSocket
-from client_ui import msg_handler, clear_current_line
-from crypto import get_private_key, diffie_first_step, diffie_second_step
+from server import (
+    Server, DEFAULT_PORT, SOCKET_BUFFER_SIZE, BROADCAST_RESPONSE_BYTES, BROADCAST_PACKET_BYTES
+)
+from lcsocket import LCSocket, MAX_MESSAGE_SIZE
+from client_ui import (
+    start_chat_screen, handle_resize, reset_scroll_region, add_chat, msg_handler, clear_current_line,
+    print_nol
+)
+from crypto import (
+    get_private_key, diffie_first_step, diffie_second_step, numbers_to_bytes, bytes_to_numbers
+)
 
 PROGRAM_VERSION = "0.1.2"
 
+# How long to wait for hosts to answer a discovery broadcast, in seconds.
+DISCOVERY_TIMEOUT = 0.25
+
+# Reused by every room search. See get_udp_socket.
+_udp_sock = None
+_udp_sock_lock = threading.Lock()
+
+# Cached by get_broadcast_addresses.
+_broadcast_addresses = None
+
+class ThreadedStdin:
+    """
+    Lines typed on stdin, in a form selectors can wait on.
+    On Windows only sockets can be selected, so a thread reads stdin and
+    wakes the selector through a socket pair, one byte per line.
+    """
+
+    def __init__(self) -> None:
+        self._lines = queue.SimpleQueue()
+        self._wakeup_sock, self._notify_sock = socket.socketpair()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+
+
+    def _read_lines(self) -> None:
+        """
+        Pass each line on to the selecting thread, until stdin is closed.
+        """
+        while True:
+            line = sys.stdin.readline()
+            self._lines.put(line)
+            self._notify_sock.send(b"\0")
+            if line == "":
+                return
+
+
+    def fileno(self) -> int:
+        """
+        Get the file descriptor to select on. Readable while there are lines waiting.
+        """
+        return self._wakeup_sock.fileno()
+
+
+    def readline(self) -> str:
+        """
+        Get the next line, or "" once stdin is closed. Only call when readable.
+        """
+        self._wakeup_sock.recv(1)
+        return self._lines.get()
+
+
 def user_choose_host() -> str:
     """
     Display available hosts and let the user pick one.
     """
     # get available rooms
     hosts = get_available_rooms()
+    if not hosts:
+        # The network may have changed since the interfaces were last looked up
+        refresh_broadcast_addresses()
+        hosts = get_available_rooms()
     # user choice for which one
     print(f"Found {len(hosts)} hosts.")
     for i, host in enumerate(hosts):
@@ -62,6 +126,13 @@ def connect_to_server() -> socket.socket:
 
     port = DEFAULT_PORT
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Send small chat packets straight away instead of waiting to coalesce them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Notice a dead host even when nothing is being sent
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Buffer sizes must be set before connecting to affect the TCP window
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
     sock.connect((hostname, port))
 
     return sock
@@ -70,6 +141,25 @@ def connect_to_server() -> socket.socket:
 def get_broadcast_addresses() -> List[str]:
     """
     Return a list of broadcast addresses.
+    The interfaces are only looked up the first time. See refresh_broadcast_addresses.
+    """
+    global _broadcast_addresses
+    if _broadcast_addresses is None:
+        _broadcast_addresses = find_broadcast_addresses()
+    return _broadcast_addresses
+
+
+def refresh_broadcast_addresses() -> None:
+    """
+    Forget the cached broadcast addresses, so they are looked up again on next use.
+    """
+    global _broadcast_addresses
+    _broadcast_addresses = None
+
+
+def find_broadcast_addresses() -> List[str]:
+    """
+    Look up the broadcast address of every network interface.
     """
     broadcast_addresses = []
 
@@ -88,32 +178,58 @@ def get_broadcast_addresses() -> List[str]:
     return broadcast_addresses
 
 
+def get_udp_socket() -> socket.socket:
+    """
+    Get the UDP socket used to search for rooms, creating it the first time.
+    """
+    global _udp_sock
+    with _udp_sock_lock:
+        if _udp_sock is None:
+            _udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _udp_sock.setblocking(False)
+            # Tell socket to allow broadcasting.
+            _udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            # Bind now, since Windows fails the recvfrom that drains late replies on an unbound socket
+            _udp_sock.bind(("", 0))
+        return _udp_sock
+
+
 def get_available_rooms() -> List[Tuple[str, str]]:
     """
     Using UDP, broadcast a message and receive the addresses of hosts on LAN.
     """
     broadcast_addresses = get_broadcast_addresses()
 
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.settimeout(0.25)
+    udp_sock = get_udp_socket()
 
-    # Tell socket to allow broadcasting.
-    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    # Throw away late replies to an earlier search
+    try:
+        while True:
+            udp_sock.recvfrom(4096)
+    except BlockingIOError:
+        pass
 
     for broadcast_address in broadcast_addresses:
-        udp_sock.sendto(BROADCAST_PACKET.encode(), (broadcast_address, DEFAULT_PORT))
+        udp_sock.sendto(BROADCAST_PACKET_BYTES, (broadcast_address, DEFAULT_PORT))
 
     all_rooms = []
 
-    try:
-        while True:
-            response, addr = udp_sock.recvfrom(4096)
-            response = response.decode()
-            if BROADCAST_RESPONSE in response:
-                name = response.split(BROADCAST_RESPONSE)[1]
-                all_rooms.append((name,addr[0]))
-    except (TimeoutError, socket.timeout):
-        pass
+    selector = selectors.DefaultSelector()
+    selector.register(udp_sock, selectors.EVENT_READ)
+
+    # Collect replies until the deadline, reading each one as soon as it arrives.
+    deadline = time.monotonic() + DISCOVERY_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not selector.select(timeout=remaining):
+            break
+        response, addr = udp_sock.recvfrom(4096)
+        # Only the room name needs decoding
+        _head, found, name = response.partition(BROADCAST_RESPONSE_BYTES)
+        if found:
+            all_rooms.append((name.decode(), addr[0]))
+
+    selector.close()
 
     return all_rooms
 
@@ -137,16 +253,20 @@ def setup_encryption(lcsocket: LCSocket) -> None:
     """
     Communicate with the server to set up encryption using Diffie Hellman.
     """
-    large_prime_n, large_prime_g, other_public_key = lcsocket.full_receive()["message"].split(",")
-    large_prime_n = int(large_prime_n)
-    large_prime_g = int(large_prime_g)
-    other_public_key = int(other_public_key)
+    large_prime_n, large_prime_g, other_public_key = bytes_to_numbers(
+        lcsocket.full_receive()["message"], 3
+    )
+    width = (large_prime_n.bit_length() + 7) // 8
 
     private_key = get_private_key(large_prime_n)
     public_key = diffie_first_step(private_key, large_prime_n, large_prime_g)
 
     lcsocket.full_send(
-        {"action": "SETUP_ENCRYPTION", "message": str(public_key), "source": "CLIENT"}
+        {
+            "action": "SETUP_ENCRYPTION",
+            "message": numbers_to_bytes([public_key], width),
+            "source": "CLIENT"
+        }
     )
 
     symmetrical_key = diffie_second_step(other_public_key, private_key, large_prime_n)
@@ -198,27 +318,62 @@ def main():
     if not name:
         name = input("Name: ")
     lcsocket.full_send({"action": "CONNECT", "message": name, "source": name})
+    # Our name is the source of every message we send, so only encode it once
+    source = name.encode()
 
-    ui_thread = threading.Thread(target=msg_handler, args=(lcsocket,))
-    ui_thread.start()
-    time.sleep(0.1)
+    resize_sock = start_chat_screen()
+    print_nol("> ")
 
-    while True:
-        msg = input("> ")
-        clear_current_line()
-        if not lcsocket.is_connected():
-            break
-        if msg != "":
-            try:
-                lcsocket.full_send({"action": "MESSAGE", "message": msg, "source": name})
-            except BrokenPipeError:
-                break
+    # Wait on whichever of the keyboard and the host has something for us
+    # Windows can't select on stdin, so it is read on a thread there
+    keyboard = ThreadedStdin() if os.name == "nt" else sys.stdin
+    selector = selectors.DefaultSelector()
+    selector.register(keyboard, selectors.EVENT_READ)
+    selector.register(lcsocket, selectors.EVENT_READ)
+    if resize_sock is not None:
+        selector.register(resize_sock, selectors.EVENT_READ)
 
-    if am_host:
-        server.join()
+    try:
+        running = True
+        while running:
+            for key, _events in selector.select():
+                if key.fileobj is resize_sock:
+                    handle_resize(resize_sock)
+                    continue
+
+                if key.fileobj is lcsocket:
+                    if not msg_handler(lcsocket):
+                        selector.unregister(lcsocket)
+                        # Nothing left to wait for if input was already closed
+                        running = keyboard in selector.get_map()
+                    continue
 
-    ui_thread.join()
+                msg = keyboard.readline()
+                clear_current_line()
+                if not lcsocket.is_connected():
+                    running = False
+                    break
+                if msg == "":
+                    # Input closed, so leave the room and wait for the host to confirm
+                    selector.unregister(keyboard)
+                    msg = "/q"
+                msg = msg.rstrip("\n")
+                if len(msg.encode()) > MAX_MESSAGE_SIZE:
+                    add_chat("Message too long to send.")
+                elif msg != "":
+                    try:
+                        lcsocket.send_message(source, msg)
+                    except BrokenPipeError:
+                        running = False
+                        break
+                print_nol("> ")
+    finally:
+        selector.close()
+        # Give the terminal its whole screen back, however the chat ended
+        reset_scroll_region()
 
+    if am_host:
+        server.join()
 
 if __name__ == "__main__":
     main()
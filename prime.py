@@ -2,31 +2,76 @@
 Functions for getting prime numbers.
 """
 
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from math import gcd, prod
 from random import randrange
+import os
+import platform
+import secrets
+import shutil
+import subprocess
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# Candidates are picked on a 2, 3, 5, 7 wheel: WHEEL * k + r for an r coprime to WHEEL.
+# That skips the ~77% of numbers divisible by one of those before any other work.
+WHEEL = 2 * 3 * 5 * 7
+WHEEL_RESIDUES = tuple(residue for residue in range(WHEEL) if gcd(residue, WHEEL) == 1)
 
 def get_random_bit_sized_int(size: int) -> int:
     """
-    Get a random number of `size` number of bits.
+    Get a random number of `size` number of bits that isn't divisible by 2, 3, 5 or 7.
     """
-    return randrange(2**(size-1) + 1, 2**size - 1)
+    low = (1 << (size - 1)) + 1
+    high = (1 << size) - 1
+    first_turn = low // WHEEL
+    turns = high // WHEEL + 1 - first_turn
+    while True:
+        # secrets rather than random: this is a Diffie Hellman modulus, and forked
+        # worker processes would otherwise share the Mersenne Twister state.
+        candidate = WHEEL * (first_turn + secrets.randbelow(turns)) \
+            + WHEEL_RESIDUES[secrets.randbelow(len(WHEEL_RESIDUES))]
+        # The first and last turns of the wheel can land just outside the range
+        if low <= candidate < high:
+            return candidate
+
+FIRST_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59,
+                61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131,
+                137, 139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197,
+                199, 211, 223, 227, 229, 233, 239, 241, 251, 257, 263, 269, 271,
+                277, 281, 283, 293, 307, 311, 313, 317, 331, 337, 347, 349)
+# Product of FIRST_PRIMES. A number shares a factor with it iff a first prime divides the number.
+PRIMORIAL = prod(FIRST_PRIMES)
 
 def is_low_lvl_prime(num: int) -> bool:
     """
     Check if the number is a prime by checking if any small primes divide into it.
     """
-    first_primes = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59,
-                    61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131,
-                    137, 139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197,
-                    199, 211, 223, 227, 229, 233, 239, 241, 251, 257, 263, 269, 271,
-                    277, 281, 283, 293, 307, 311, 313, 317, 331, 337, 347, 349]
-
-    for divisor in first_primes:
-        if num % divisor == 0:
-            break
+    if num <= FIRST_PRIMES[-1]:
+        return num in FIRST_PRIMES
 
-        return True
+    # A single gcd in C instead of a Python-level % for every small prime
+    return gcd(num, PRIMORIAL) == 1
+
+# Each Rabin Miller trial at least quarters the chance of a composite passing,
+# so 40 trials leave at most a 2^-80 chance.
+RABIN_TRIALS = 40
+
+# Testing against every one of these bases proves primality for any number below
+# DETERMINISTIC_BOUND. Above it they still reject most composites before a random base is drawn.
+DETERMINISTIC_WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+DETERMINISTIC_BOUND = 3317044064679887385961981
 
-    return False
+# Candidates tested per search_candidates call, which is one unit of work for a worker process.
+CANDIDATES_PER_SEARCH = 64
+# Smaller primes are found before worker processes would even have started.
+PARALLEL_MIN_SIZE = 128
+
+PRIME_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prime_worker.py")
 
 # I didn't feel like implementing Rabin Miller test myself.
 # https://www.geeksforgeeks.org/how-to-generate-large-prime-numbers-for-rsa-algorithm/
@@ -38,24 +83,33 @@ def is_high_lvl_prime(num: int) -> bool:
     Use Rabin Miller algorithm to check if prime.
     """
     max_division_by_two = 0
-    even_component = num-1
+    num_minus_one = num - 1
+    even_component = num_minus_one
 
     while even_component % 2 == 0:
         even_component >>= 1
         max_division_by_two += 1
-    assert 2**max_division_by_two * even_component == num-1
 
     def trial_composite(round_tester):
-        if pow(round_tester, even_component, num) == 1:
+        witness = pow(round_tester, even_component, num)
+        if witness == 1 or witness == num_minus_one:
             return False
-        for i in range(max_division_by_two):
-            if pow(round_tester, 2**i * even_component, num) == num - 1:
+        # Square the previous power instead of raising round_tester to each 2**i from scratch
+        for _ in range(max_division_by_two - 1):
+            witness = witness * witness % num
+            if witness == num_minus_one:
                 return False
         return True
 
-    # Set number of trials here
-    number_of_rabin_trials = 2**10
-    for _ in range(number_of_rabin_trials):
+    for round_tester in DETERMINISTIC_WITNESSES:
+        if round_tester >= num:
+            break
+        if trial_composite(round_tester):
+            return False
+    if num < DETERMINISTIC_BOUND:
+        return True
+
+    for _ in range(RABIN_TRIALS):
         round_tester = randrange(2, num)
         if trial_composite(round_tester):
             return False
@@ -67,13 +121,74 @@ def get_prime_of_size(size: int) -> int:
     """
     Get a prime number with `size` number of bits.
     """
+    if gmpy2 is not None:
+        # GMP's sieve and Miller Rabin in C, rather than the Python version below
+        while True:
+            prime_candidate = get_random_bit_sized_int(size)
+            if gmpy2.is_prime(prime_candidate, RABIN_TRIALS):
+                return prime_candidate
+
+    if size >= PARALLEL_MIN_SIZE:
+        pypy = shutil.which("pypy3")
+        if pypy is not None and platform.python_implementation() != "PyPy":
+            prime = get_prime_from_pypy(pypy, size)
+            if prime is not None:
+                return prime
+
+        workers = os.cpu_count() or 1
+        if workers > 1:
+            return search_in_parallel(size, workers)
+
     while True:
-        # print("Getting random pc")
+        prime = search_candidates(size)
+        if prime is not None:
+            return prime
+
+
+def get_prime_from_pypy(pypy: str, size: int) -> Optional[int]:
+    """
+    Get a prime with `size` number of bits by running prime_worker.py under PyPy.
+    Returns None if that failed.
+    """
+    try:
+        result = subprocess.run(
+            [pypy, PRIME_WORKER_PATH, str(size)],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return int(result.stdout)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def search_candidates(size: int) -> Optional[int]:
+    """
+    Test a batch of random candidates with `size` number of bits.
+    Returns the first prime found, or None if there wasn't one.
+    """
+    for _ in range(CANDIDATES_PER_SEARCH):
         prime_candidate = get_random_bit_sized_int(size)
-        # print("Checking if pc is low lvl prime")
         if not is_low_lvl_prime(prime_candidate):
             continue
-        # print("Checking if pc is high lvl prime")
         if is_high_lvl_prime(prime_candidate):
-            print()
             return prime_candidate
+    return None
+
+
+def search_in_parallel(size: int, workers: int) -> int:
+    """
+    Run search_candidates in `workers` processes and return the first prime any of them finds.
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        searches = {executor.submit(search_candidates, size) for _ in range(workers)}
+        while True:
+            finished, searches = wait(searches, return_when=FIRST_COMPLETED)
+            for search in finished:
+                prime = search.result()
+                if prime is not None:
+                    for search in searches:
+                        search.cancel()
+                    return prime
+                # Keep every worker busy until a prime turns up
+                searches.add(executor.submit(search_candidates, size))
@@ -0,0 +1,12 @@
+"""
+Print a prime number with the number of bits given as the only argument.
+prime.py runs this under PyPy when it is installed, as its JIT runs the pure Python
+primality tests much faster than CPython.
+"""
+
+import sys
+
+from prime import get_prime_of_size
+
+if __name__ == "__main__":
+    print(get_prime_of_size(int(sys.argv[1])))
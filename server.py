@@ -3,22 +3,90 @@ This module holds the server-side code of the P2P application.
 """
 
 from __future__ import annotations
-from typing import List, Tuple, Dict
+from typing import Callable, Deque, List, Tuple, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import selectors
 import socket
 from threading import Thread
-from queue import Queue
-import time
+import os
 import sys
+import time
 
 import netifaces
 
-from crypto import get_n_and_g, get_private_key, diffie_first_step, diffie_second_step
-from lcsocket import LCSocket
+from crypto import (
+    get_n_and_g, get_private_key, diffie_first_step, diffie_second_step, numbers_to_bytes, mpz
+)
+from lcsocket import (
+    LCSocket, ConnectionClosed, BadPacket, pack_packet, pack_message, MAX_MESSAGE_SIZE
+)
 
 DEFAULT_PORT = 29001
 
+SOCKET_BUFFER_SIZE = 65536
+
 BROADCAST_PACKET = "lan-chat-find"
+BROADCAST_PACKET_BYTES = BROADCAST_PACKET.encode()
 BROADCAST_RESPONSE = "lan-chat-found-"
+BROADCAST_RESPONSE_BYTES = BROADCAST_RESPONSE.encode()
+# Room searches can arrive in bursts, so buffer plenty of them in the kernel
+BROADCAST_RECV_BUFFER_SIZE = 1 << 18
+
+# Error packets that never change, packed once. See pack_packet.
+ERR_NOT_CONNECTED = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 1: CANNOT SEND MESSAGE BEFORE FULLY CONNECTED",
+    "source": "SERVER"
+})
+ERR_BLANK_NAME = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 2: NAME CANNOT BE BLANK",
+    "source": "SERVER"
+})
+ERR_MISSING_TARGET = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 4: MISSING COMMAND TARGET",
+    "source": "SERVER"
+})
+ERR_NO_SUCH_TARGET = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 5: COMMAND TARGET DOES NOT EXIST",
+    "source": "SERVER"
+})
+ERR_TARGET_NOT_INTEGER = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 6: TARGET MUST BE INTEGER",
+    "source": "SERVER"
+})
+ERR_ONLY_HOST_CAN_KICK = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 7: ONLY HOST CAN KICK",
+    "source": "SERVER"
+})
+ERR_CANNOT_KICK_HOST = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 8: CANNOT KICK HOST",
+    "source": "SERVER"
+})
+ERR_MESSAGE_TOO_LONG = pack_packet({
+    "action": "ERROR",
+    "message": "ERR 9: MESSAGE TOO LONG",
+    "source": "SERVER"
+})
+
+# Queued for a client whose connection failed, so the server disconnects it.
+# Handled even for clients that never finished connecting, unlike a /q message.
+LOST_CONNECTION_PACKET = {"action": "DISCONNECT", "message": "", "source": "CLIENT"}
+
+# Clients whose encryption can be set up at once. See ConnectionGetter.
+HANDSHAKE_WORKERS = 4
+# Seconds a client gets to finish setting up encryption, so silent clients can't hold every worker.
+# Also the longest the server waits on handshakes when it stops.
+HANDSHAKE_TIMEOUT = 5
+
+# Cached by get_ip_addresses.
+_ip_addresses = None
 
 class NoMoreClients(Exception):
     """
@@ -29,13 +97,24 @@ class NoMoreClients(Exception):
 def get_ip_addresses() -> List[str]:
     """
     Get a list of IP addresses that this host has.
+    The interfaces are only looked up the first time.
+    """
+    global _ip_addresses
+    if _ip_addresses is None:
+        _ip_addresses = find_ip_addresses()
+    return _ip_addresses
+
+
+def find_ip_addresses() -> List[str]:
+    """
+    Look up the IP addresses of every network interface.
     """
     addresses = []
     for interface in netifaces.interfaces():
         interface_addresses = netifaces.ifaddresses(interface)
-        if netifaces.AF_INET in interface_addresses.keys():
+        if netifaces.AF_INET in interface_addresses:
             for address in interface_addresses[netifaces.AF_INET]:
-                if "addr" in address.keys():
+                if "addr" in address:
                     addresses.append(address["addr"])
     return addresses
 
@@ -46,42 +125,63 @@ def reply_to_broadcasts(name: str, server: Server):
     to inform of this host and address.
     """
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BROADCAST_RECV_BUFFER_SIZE)
     udp_socket.bind(("", DEFAULT_PORT))
-    udp_socket.settimeout(0.2)
-    while True:
-        try:
-            data, addr = udp_socket.recvfrom(4096)
-            if data.decode() == BROADCAST_PACKET:
-                udp_socket.sendto(f"{BROADCAST_RESPONSE}{name}".encode(), addr)
-        except (TimeoutError, socket.timeout):
-            if server.is_done():
-                udp_socket.close()
-                return
+    udp_socket.setblocking(False)
+    response = f"{BROADCAST_RESPONSE}{name}".encode()
+    # One byte longer than a search packet, so longer datagrams can't match once truncated
+    buf = bytearray(len(BROADCAST_PACKET_BYTES) + 1)
+    selector = server.make_stop_selector(udp_socket)
+    while server.wait_until_readable(selector):
+        # Answer every search that has arrived before waiting again
+        while True:
+            try:
+                size, addr = udp_socket.recvfrom_into(buf)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Windows raises for a datagram too long for buf instead of truncating it
+                continue
+            # Compared as bytes, so stray datagrams that aren't UTF-8 are just ignored
+            if buf[:size] == BROADCAST_PACKET_BYTES:
+                udp_socket.sendto(response, addr)
+    selector.close()
+    udp_socket.close()
 
 
-class ClientConnection(Thread):
+class ClientConnection:
     """
-    A class to represent a connection to a client which operates as its own thread.
+    A class to represent a connection to a client.
+    The server reads every client from one selector loop rather than a thread per client.
     """
     def __init__(
             self,
             client_id: int,
             sock: LCSocket,
-            q: Queue[Tuple[Dict[str, str], ClientConnection]]
+            q: Deque[Tuple[Dict[str, str], ClientConnection]]
         ) -> None:
         """
         Initialize.
         q: The queue to put received messages on.
         """
-        super().__init__()
         self._client_id = client_id
         self._sock = sock
-        self._sock.settimeout(0.2)
         self._q = q
         self._name = ""
-        self._stopped = False
+        # Formatted by set_name, rather than every time get_name is called
+        self._full_name = f"#{client_id}:"
+        # get_name encoded, as the source of every message this client sends
+        self._name_bytes = self._full_name.encode()
         self._connected = True
 
+        # Packets that arrived along with the end of the encryption setup are already
+        # buffered and won't make the socket readable again.
+        try:
+            while self._sock.has_packet():
+                self._q.append((self._sock.full_receive(), self))
+        except BadPacket:
+            self._connection_lost()
+
 
     def is_ready(self) -> bool:
         """
@@ -90,23 +190,34 @@ class ClientConnection(Thread):
         return self._name != ""
 
 
-    def run(self):
+    def fileno(self) -> int:
         """
-        Run the thread.
+        Get the file descriptor of the client's socket, so it can be used with selectors.
         """
-        while not self._stopped:
-            try:
-                self._q.put((self._sock.full_receive(), self))
-            except (TimeoutError, socket.timeout):
-                continue
-            except OSError as error:
-                if self._stopped:
-                    break
-                print("ERR:", error, str(error))
-            except AttributeError:
-                # Trying to decrypt when disconnected yields attributeerror. So, disconnect.
-                self._q.put(({"action": "MESSAGE", "message": "/q", "source": "CLIENT"}, self))
-                self._connected = False
+        return self._sock.fileno()
+
+
+    def receive(self) -> bool:
+        """
+        Put the packets that have arrived from this client on the queue.
+        Call when the socket is readable. Returns False once the client has disconnected.
+        """
+        try:
+            for packet in self._sock.receive_available():
+                self._q.append((packet, self))
+        except (ConnectionClosed, BadPacket, OSError):
+            # A client sending packets that don't decrypt is treated as gone
+            self._connection_lost()
+        return self._connected
+
+
+    def _connection_lost(self) -> None:
+        """
+        Have the server disconnect this client, the first time its connection fails.
+        """
+        if self._connected:
+            self._connected = False
+            self._q.append((LOST_CONNECTION_PACKET, self))
 
 
     def set_name(self, name: str) -> None:
@@ -114,25 +225,39 @@ class ClientConnection(Thread):
         Set the client name.
         """
         self._name = name
+        self._full_name = f"#{self._client_id}:{name}"
+        self._name_bytes = self._full_name.encode()
 
 
     def get_name(self) -> str:
         """
         Get the client name in form "#{id}:{name}"
         """
-        return f"#{self._client_id}:{self._name}"
+        return self._full_name
+
+
+    def get_name_bytes(self) -> bytes:
+        """
+        Get the client name as returned by get_name, encoded as UTF-8.
+        """
+        return self._name_bytes
 
 
     def send(self, packet: Dict[str, str]) -> None:
         """
         Send a packet to this client.
         """
+        self.send_payload(pack_packet(packet))
+
+
+    def send_payload(self, payload: bytes) -> None:
+        """
+        Send a packet already packed by pack_packet to this client.
+        """
         try:
-            self._sock.full_send(packet)
-        except BrokenPipeError:
-            # Trick server into seeing client disconnecting
-            self._q.put(({"action": "MESSAGE", "message": "/q", "source": "CLIENT"}, self))
-            self._connected = False
+            self._sock.send_payload(payload)
+        except OSError:
+            self._connection_lost()
 
 
     def get_id(self) -> int:
@@ -146,7 +271,6 @@ class ClientConnection(Thread):
         """
         Disconnect from the server. Send the specified message to the client.
         """
-        self._stopped = True
         if self._connected:
             self.send({"action": "DISCONNECT", "message": msg, "source": "SERVER"})
         self._sock.close()
@@ -165,44 +289,100 @@ class Server(Thread):
         # Calculate our partial key
         self._partial_key = diffie_first_step(self._private_key, self._n, self._g)
 
-        self._q: Queue[Tuple[Dict[str, str], ClientConnection]] = Queue()
-        self._clients: List[ClientConnection] = []
+        # Only the server thread uses this, so it needs no locking
+        self._q: Deque[Tuple[Dict[str, str], ClientConnection]] = deque()
+        # Keyed by client ID, in the order the clients joined
+        self._clients: Dict[int, ClientConnection] = {}
+
+        # Every client socket is read from this selector on the server thread.
+        # Clients accepted by the ConnectionGetter thread wait in _new_clients,
+        # and a byte on the wakeup socket tells the selector to pick them up.
+        self._selector = selectors.DefaultSelector()
+        # deque's append and popleft are atomic, so the two threads need no lock around it.
+        self._new_clients: Deque[LCSocket] = deque()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+
+        # Written to once the server is done, which wakes the other threads so they stop.
+        # Never read from, so it stays readable for every thread waiting on it.
+        self._stop_reader, self._stop_writer = socket.socketpair()
 
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Rebind straight away when restarting, instead of waiting out the old
+        # connections' TIME_WAIT. Windows doesn't hold ports in TIME_WAIT like that,
+        # and there the option would let a second room bind the same port.
+        if os.name != "nt":
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             self._sock.bind(("", DEFAULT_PORT))
         except OSError:
             print("The port for this application is already in use or wasn't properly freed.")
             print("Would you like to wait until it's available? (y/n)")
-            if input("> ") == "y":
-                num_dots = 0
-                success = False
-                while not success:
-                    print("\033[2K\033[0EWaiting" + "." * num_dots + "\033[0E", end="", flush=True)
-                    num_dots = (num_dots + 1) % 4
-                    try:
-                        self._sock.bind(("", DEFAULT_PORT))
-                        success = True
-                    except OSError:
-                        time.sleep(0.15)
-                print("\033[2K\033[0EPort acquired.")
-                time.sleep(3)
-            else:
+            if input("> ") != "y":
                 sys.exit()
+            self._wait_for_port()
 
+        # Accepted sockets take their buffer sizes from here, which must be set before
+        # connecting to affect the TCP window
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
         self._sock.listen(1)
-        self._sock.settimeout(0.2)
+        self._accept_selector = self.make_stop_selector(self._sock)
 
         self._next_client_id = 0
 
         self._replier_thread = None
 
-        self._ips = get_ip_addresses()
-
         self._host_name = name
 
+        # The start of the info message doesn't change while the server runs
+        self._info_prefix = (
+            "Server info:\n"
+            "         ---------------------\n"
+            f"         Server name: {name}\n"
+            f"         Server IPs: {', '.join(get_ip_addresses())}\n"
+        )
+
         self._done = False
 
+        # The help message never changes, so it is only packed once
+        self._help_payload = pack_packet({
+            "action": "MESSAGE",
+            "message": self._help_msg(),
+            "source": "SERVER"
+        })
+
+        # Handlers by packet action, and by chat command name
+        self._packet_handlers: Dict[str, Callable[[ClientConnection, str], None]] = {
+            "MESSAGE": self._handle_message,
+            "CONNECT": self._handle_connect,
+            "DISCONNECT": self._handle_disconnect
+        }
+        self._command_handlers: Dict[str, Callable[[ClientConnection, List[str]], None]] = {
+            "info": self._info_command,
+            "h": self._help_command,
+            "help": self._help_command,
+            "q": self._quit_command,
+            "quit": self._quit_command,
+            "kick": self._kick_command
+        }
+
+
+    def _wait_for_port(self) -> None:
+        """
+        Retry binding the server socket until the port is free.
+        """
+        num_dots = 0
+        while True:
+            print("\033[2K\033[0EWaiting" + "." * num_dots + "\033[0E", end="", flush=True)
+            num_dots = (num_dots + 1) % 4
+            try:
+                self._sock.bind(("", DEFAULT_PORT))
+                break
+            except OSError:
+                time.sleep(0.5)
+        print("\033[2K\033[0EPort acquired.")
+
 
     def run(self) -> None:
         """
@@ -223,10 +403,17 @@ class Server(Thread):
                 self._handle_packet(packet, sender)
             except NoMoreClients:
                 self._done = True
-                connections_thread.stop()
+                self._stop_writer.send(b"\0")
                 connections_thread.join()
                 if self._replier_thread is not None:
                     self._replier_thread.join()
+                self._selector.close()
+                self._accept_selector.close()
+                self._wakeup_reader.close()
+                self._wakeup_writer.close()
+                self._stop_reader.close()
+                self._stop_writer.close()
+                self._sock.close()
                 return
 
 
@@ -237,6 +424,36 @@ class Server(Thread):
         return self._done
 
 
+    def make_stop_selector(self, sock: socket.socket) -> selectors.BaseSelector:
+        """
+        Make a selector for wait_until_readable that waits on `sock` and on the server being done.
+        Make it once and reuse it, so the sockets aren't registered again for every wait.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(self._stop_reader, selectors.EVENT_READ)
+        return selector
+
+
+    def wait_until_readable(self, selector: selectors.BaseSelector) -> bool:
+        """
+        Block until the socket of a selector from make_stop_selector is readable
+        or the server is done. Returns False if the server is done.
+        """
+        for key, _events in selector.select():
+            if key.fileobj is self._stop_reader:
+                return False
+        return True
+
+
+    def wait_for_connection(self) -> bool:
+        """
+        Block until a client can be accepted or the server is done.
+        Returns False if the server is done.
+        """
+        return self.wait_until_readable(self._accept_selector)
+
+
     def make_visible(self):
         """
         Start the thread that responds to broadcasts,
@@ -250,16 +467,13 @@ class Server(Thread):
         """
         Get the server info message.
         """
-        msg =   "Server info:\n"
-        msg +=  "         ---------------------\n"
-        msg += f"         Server name: {self._host_name}\n"
-        msg += f"         Server IPs: {', '.join(self._ips)}\n"
-        msg += f"         Host: {self._clients[0].get_name()}\n"
-        msg += f"         Connected users: {len(self._clients)}\n"
-        for client in self._clients:
-            msg += f"           {client.get_name()}\n"
-        msg += f"         Your username is {sender.get_name()}"
-        return msg
+        lines = [
+            f"{self._info_prefix}         Host: {self._clients[0].get_name()}",
+            f"         Connected users: {len(self._clients)}"
+        ]
+        lines.extend(f"           {client.get_name()}" for client in self._clients.values())
+        lines.append(f"         Your username is {sender.get_name()}")
+        return "\n".join(lines)
 
 
     def _help_msg(self) -> str:
@@ -293,19 +507,28 @@ class Server(Thread):
             msg = "{0} was kicked."
             client_msg = "You were kicked from the room. Press enter to quit."
 
-        for client in reversed(self._clients):
-            if client.get_id() == client_id or client_id == 0:
-                client.disconnect(client_msg)
-                client.join()
-                self._clients.remove(client)
-                self._send_all_clients({
-                    "action": "MESSAGE",
-                    "message": msg.format(client.get_name()),
-                    "source": "SERVER"
-                })
-                if len(self._clients) == 0:
-                    raise NoMoreClients
-                disconnected = True
+        # The host leaving closes the room, so everyone else goes first
+        if client_id == 0:
+            clients = list(reversed(self._clients.values()))
+        elif client_id in self._clients:
+            clients = [self._clients[client_id]]
+        else:
+            clients = []
+
+        for client in clients:
+            # A client that closed its end has already been unregistered
+            if client in self._selector.get_map():
+                self._selector.unregister(client)
+            client.disconnect(client_msg)
+            del self._clients[client.get_id()]
+            self._send_all_clients({
+                "action": "MESSAGE",
+                "message": msg.format(client.get_name()),
+                "source": "SERVER"
+            })
+            if len(self._clients) == 0:
+                raise NoMoreClients
+            disconnected = True
         return disconnected
 
 
@@ -313,63 +536,60 @@ class Server(Thread):
         """
         Handle the command that the user sent.
         """
-        msg = ""
         split_cmd = cmd.split()
         if len(split_cmd) == 0:
             return
-        if cmd == "info":
-            msg = self._info_msg(sender)
-        elif cmd == "help" or cmd == "h":
-            msg = self._help_msg()
-        elif cmd in ("q", "quit"):
-            self._disconnect_client(sender.get_id())
-            return
-        elif split_cmd[0] == "kick":
-            if sender.get_id() != 0:
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 7: ONLY HOST CAN KICK",
-                    "source": "SERVER"
-                })
-                return
-            if len(split_cmd) < 2:
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 4: MISSING COMMAND TARGET",
-                    "source": "SERVER"
-                })
-                return
-            if not split_cmd[1].isdigit():
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 6: TARGET MUST BE INTEGER",
-                    "source": "SERVER"
-                })
-                return
-            if split_cmd[1] == "0":
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 8: CANNOT KICK HOST",
-                    "source": "SERVER"
-                })
-                return
-            success = self._disconnect_client(int(split_cmd[1]), "kick")
-            if not success:
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 5: COMMAND TARGET DOES NOT EXIST",
-                    "source": "SERVER"
-                })
-            return
-        else:
+        handler = self._command_handlers.get(split_cmd[0])
+        if handler is None:
             sender.send({
                 "action": "ERROR",
                 "message": f"ERR 3: UNKNOWN COMMAND: /{cmd}",
                 "source": "SERVER"
             })
             return
+        handler(sender, split_cmd[1:])
 
-        sender.send({"action": "MESSAGE", "message": msg, "source": "SERVER"})
+
+    def _info_command(self, sender: ClientConnection, _args: List[str]) -> None:
+        """
+        Handle /info.
+        """
+        sender.send({"action": "MESSAGE", "message": self._info_msg(sender), "source": "SERVER"})
+
+
+    def _help_command(self, sender: ClientConnection, _args: List[str]) -> None:
+        """
+        Handle /h and /help.
+        """
+        sender.send_payload(self._help_payload)
+
+
+    def _quit_command(self, sender: ClientConnection, _args: List[str]) -> None:
+        """
+        Handle /q and /quit.
+        """
+        self._disconnect_client(sender.get_id())
+
+
+    def _kick_command(self, sender: ClientConnection, args: List[str]) -> None:
+        """
+        Handle /kick {id}.
+        """
+        if sender.get_id() != 0:
+            sender.send_payload(ERR_ONLY_HOST_CAN_KICK)
+            return
+        if len(args) < 1:
+            sender.send_payload(ERR_MISSING_TARGET)
+            return
+        if not args[0].isdigit():
+            sender.send_payload(ERR_TARGET_NOT_INTEGER)
+            return
+        if args[0] == "0":
+            sender.send_payload(ERR_CANNOT_KICK_HOST)
+            return
+        success = self._disconnect_client(int(args[0]), "kick")
+        if not success:
+            sender.send_payload(ERR_NO_SUCH_TARGET)
 
 
     def _handle_packet(self, packet: Dict[str, str], sender: ClientConnection) -> None:
@@ -382,56 +602,104 @@ class Server(Thread):
 
         except KeyError:
             return
+        # JSON packets from a misbehaving client could hold any type
+        if not isinstance(action, str) or not isinstance(msg, str):
+            return
 
-        if action == "MESSAGE":
-            if not sender.is_ready():
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 1: CANNOT SEND MESSAGE BEFORE FULLY CONNECTED",
-                    "source": "SERVER"
-                })
-                return
-            if msg[0] == "/" or msg[0] == "\\":
-                self._handle_command(sender, msg[1:])
-                return
-            self._send_all_clients({
-                "action": "MESSAGE",
-                "message": msg,
-                "source": sender.get_name()
-            })
+        handler = self._packet_handlers.get(action)
+        if handler is not None:
+            handler(sender, msg)
+
+
+    def _handle_message(self, sender: ClientConnection, msg: str) -> None:
+        """
+        Handle a MESSAGE packet: a chat message or a command.
+        """
+        if not sender.is_ready():
+            sender.send_payload(ERR_NOT_CONNECTED)
             return
+        if msg.startswith(("/", "\\")):
+            self._handle_command(sender, msg[1:])
+            return
+        # Relaying it could make a packet too long for the other clients to accept
+        if len(msg.encode()) > MAX_MESSAGE_SIZE:
+            sender.send_payload(ERR_MESSAGE_TOO_LONG)
+            return
+        self._send_all_payload(pack_message(sender.get_name_bytes(), msg))
 
-        if action == "CONNECT":
-            if msg == "":
-                sender.send({
-                    "action": "ERROR",
-                    "message": "ERR 2: NAME CANNOT BE BLANK",
-                    "source": "SERVER"
-                })
-                return
 
-            sender.set_name(msg)
-            self._send_all_clients({
-                "action": "MESSAGE",
-                "message": f"{sender.get_name()} has joined.",
-                "source": "SERVER"
-            })
+    def _handle_disconnect(self, sender: ClientConnection, _msg: str) -> None:
+        """
+        Handle a DISCONNECT packet, queued when a client's connection failed.
+        """
+        self._disconnect_client(sender.get_id())
+
+
+    def _handle_connect(self, sender: ClientConnection, msg: str) -> None:
+        """
+        Handle a CONNECT packet, which sets the client's name.
+        """
+        if msg == "":
+            sender.send_payload(ERR_BLANK_NAME)
             return
 
+        sender.set_name(msg)
+        self._send_all_clients({
+            "action": "MESSAGE",
+            "message": f"{sender.get_name()} has joined.",
+            "source": "SERVER"
+        })
+
 
     def _send_all_clients(self, packet: Dict[str, str]) -> None:
         """
         Send the packet to all clients.
         """
-        for client in self._clients:
-            client.send(packet)
+        self._send_all_payload(pack_packet(packet))
+
+
+    def _send_all_payload(self, payload: bytes) -> None:
+        """
+        Send a packet already packed by pack_packet or pack_message to all clients.
+        """
+        # Packed once. Each client has its own key, so only the encryption is per client.
+        for client in self._clients.values():
+            client.send_payload(payload)
 
 
     def _recv(self) -> Tuple[Dict[str, str], ClientConnection]:
         """
-        Receive the next queued packet.
+        Receive the next queued packet, waiting on the client sockets until there is one.
+        """
+        while not self._q:
+            self._poll()
+        return self._q.popleft()
+
+
+    def _poll(self) -> None:
+        """
+        Wait until a client socket is readable or a client was added, and handle it.
+        """
+        for key, _events in self._selector.select():
+            if key.fileobj is self._wakeup_reader:
+                self._wakeup_reader.recv(4096)
+                self._register_new_clients()
+                continue
+            client = key.fileobj
+            if not client.receive():
+                self._selector.unregister(client)
+
+
+    def _register_new_clients(self) -> None:
+        """
+        Start managing the clients that add_client has queued up.
         """
-        return self._q.get()
+        while self._new_clients:
+            lcsock = self._new_clients.popleft()
+            client = ClientConnection(self._next_client_id, lcsock, self._q)
+            self._next_client_id += 1
+            self._clients[client.get_id()] = client
+            self._selector.register(client, selectors.EVENT_READ)
 
 
     def accept(self) -> Tuple[str, Tuple[str, int]]:
@@ -444,10 +712,10 @@ class Server(Thread):
     def add_client(self, lcsock: LCSocket) -> None:
         """
         Add a client to the server to manage.
+        Called from the ConnectionGetter thread, so the server thread does the registering.
         """
-        self._clients.append(ClientConnection(self._next_client_id, lcsock, self._q))
-        self._next_client_id += 1
-        self._clients[-1].start()
+        self._new_clients.append(lcsock)
+        self._wakeup_writer.send(b"\0")
 
 
 class ConnectionGetter(Thread):
@@ -456,38 +724,56 @@ class ConnectionGetter(Thread):
     """
     def __init__(self, server: Server, n: int, g: int, secret_key: int, partial_key: int) -> None:
         super().__init__()
-        self._stopped = False
         self._server = server
+        # Set once the server is done, so handshakes still queued are dropped rather than run
+        self._stopping = False
 
-        self._n = n
-        self._g = g
-        self._secret_key = secret_key
-        self._partial_key = partial_key
+        # Converted for gmpy2 once, rather than by powmod on every handshake
+        self._n = mpz(n)
+        self._secret_key = mpz(secret_key)
 
+        # Every client is sent the same n, g and partial key, so pack that packet once
+        width = (n.bit_length() + 7) // 8
+        self._setup_payload = pack_packet({
+            "action": "SETUP_ENCRYPTION",
+            "message": numbers_to_bytes([n, g, partial_key], width),
+            "source": "SERVER"
+        })
 
-    def stop(self) -> None:
+
+    def run(self) -> None:
         """
-        Stop this thread.
+        Run the thread. Stops once the server is done.
         """
-        self._stopped = True
+        # Key exchanges wait on the client, so one slow client mustn't hold up the rest
+        with ThreadPoolExecutor(HANDSHAKE_WORKERS) as executor:
+            while self._server.wait_for_connection():
+                client_sock, _addr = self._server.accept()
+                executor.submit(self._add_client, client_sock)
+            self._stopping = True
 
 
-    def run(self) -> None:
+    def _add_client(self, client_sock: socket.socket) -> None:
         """
-        Run the thread.
+        Set up encryption with a newly accepted client, then hand it to the server.
         """
-        while not self._stopped:
-            try:
-                client_sock, _addr = self._server.accept()
-                lcsock = LCSocket(client_sock)
-                # lcsock.setup_encryption()
-                self.setup_encryption(lcsock)
-                self._server.add_client(lcsock)
-            except (TimeoutError, socket.timeout):
-                continue
-            except ValueError:
-                lcsock.close()
-                continue
+        if self._stopping:
+            client_sock.close()
+            return
+        # Send small chat packets straight away instead of waiting to coalesce them
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Notice a client that vanished without closing its connection
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        client_sock.settimeout(HANDSHAKE_TIMEOUT)
+        lcsock = LCSocket(client_sock)
+        try:
+            self.setup_encryption(lcsock)
+        except (ValueError, ConnectionClosed, BadPacket, socket.timeout, OSError):
+            # The client sent something unexpected, left or went quiet before setup finished
+            lcsock.close()
+            return
+        client_sock.settimeout(None)
+        self._server.add_client(lcsock)
 
 
     def setup_encryption(self, lcsock: LCSocket) -> None:
@@ -497,20 +783,13 @@ class ConnectionGetter(Thread):
         Client sends one back
         """
         # Inform client of n and g and our partial key
-        try:
-            lcsock.full_send({
-                "action": "SETUP_ENCRYPTION",
-                "message": f"{self._n},{self._g},{self._partial_key}",
-                "source": "SERVER"
-            })
-        except BrokenPipeError:
-            lcsock.close()
-            return
+        lcsock.send_payload(self._setup_payload)
         # Receive client's partial key
         pack = lcsock.full_receive()
-        if pack["action"] != "SETUP_ENCRYPTION":
+        message = pack.get("message")
+        if pack.get("action") != "SETUP_ENCRYPTION" or not isinstance(message, bytes):
             raise ValueError
-        other_partial = int(pack["message"])
+        other_partial = int.from_bytes(message, "big")
 
         symmetrical_key = diffie_second_step(other_partial, self._secret_key, self._n)
 